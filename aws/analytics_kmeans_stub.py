@@ -1,16 +1,45 @@
 #!/usr/bin/env python3
-import argparse, io, os, sys, math
+import argparse, io, os, sys, math, json
 from collections import Counter
 
 import boto3
+from botocore.exceptions import ClientError
 import pandas as pd
 import numpy as np
 
 # ---------- utils ----------
+MODEL_KEY    = "analytics/kmeans/model.json"
+FEATURES_KEY = "analytics/kmeans/features.csv"
+ASSIGN_KEY   = "analytics/kmeans/assignments.csv"
+FEATURE_COLS = ["age","gender_num","obs_count","cond_nunique"]
+MISSING_CODES = {"404", "NoSuchKey", "403", "AccessDenied"}
+DRIFT_QUANTILE = 0.95   # training distance-to-center quantile stored in model.json
+MIN_DRIFT_ROWS = 30     # smaller deltas are too noisy to trigger a refit
+
 def s3_read_csv(s3, bucket, key):
     obj = s3.get_object(Bucket=bucket, Key=key)
     return pd.read_csv(io.BytesIO(obj["Body"].read()))
 
+def s3_read_optional(s3, bucket, key, parse):
+    # returns None when the object doesn't exist yet (e.g. first run);
+    # without s3:ListBucket a missing key comes back as 403, not 404
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in MISSING_CODES:
+            return None
+        raise
+    return parse(obj["Body"].read())
+
+def s3_put(s3, bucket, key, body, content_type):
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=body,
+        ContentType=content_type,
+        ServerSideEncryption="AES256"
+    )
+
 def year_to_age(y, ref_year=2025):
     try:
         y = int(y)
@@ -26,14 +55,25 @@ def gender_to_num(g):
     g = str(g or "").upper().strip()
     return {"M":0, "F":1, "O":2, "UNK":3}.get(g, 3)
 
-def zscore(df, cols):
+def zscore_params(df, cols):
+    # {col: (mean, std)} so the same scaling can be replayed on new rows
+    return {c: (float(df[c].mean()), float(df[c].std(ddof=0))) for c in cols}
+
+def zscore(df, cols, params=None):
+    if params is None:
+        params = zscore_params(df, cols)
     df = df.copy()
     for c in cols:
-        mu = df[c].mean()
-        sd = df[c].std(ddof=0)
+        mu, sd = params[c]
         df[c] = 0.0 if (sd == 0 or np.isnan(sd)) else (df[c] - mu) / sd
     return df
 
+def nearest_center(X, centers):
+    # single vectorized pass: (n, k) distances -> closest center per row
+    dists = np.linalg.norm(X[:, None, :] - centers[None, :, :], axis=2)
+    assign = dists.argmin(axis=1)
+    return assign, dists[np.arange(len(assign)), assign]
+
 def kmeans_numpy(X, k, iters=100, seed=42):
     rng = np.random.default_rng(seed)
     n = X.shape[0]
@@ -44,8 +84,7 @@ def kmeans_numpy(X, k, iters=100, seed=42):
 
     for _ in range(iters):
         # assign
-        dists = np.linalg.norm(X[:, None, :] - centers[None, :, :], axis=2)  # (n, k)
-        new_assign = dists.argmin(axis=1)
+        new_assign, _ = nearest_center(X, centers)
         if np.array_equal(new_assign, assign):
             break
         assign = new_assign
@@ -57,25 +96,12 @@ def kmeans_numpy(X, k, iters=100, seed=42):
             else:
                 # re-seed empty cluster
                 centers[j] = X[rng.integers(0, n)]
-    return assign
-
-# ---------- main ----------
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--bucket", required=True)
-    ap.add_argument("--k", type=int, default=3)
-    args = ap.parse_args()
+    return assign, centers
 
-    s3 = boto3.client("s3")
-
-    # Read curated inputs produced by the pipeline
-    person = s3_read_csv(s3, args.bucket, "curated/person/person.csv")
-    cond   = s3_read_csv(s3, args.bucket, "curated/condition_occurrence/condition_occurrence.csv")
-    obs    = s3_read_csv(s3, args.bucket, "curated/observation/observation.csv")
-
-    # Basic derived features
+def build_features(person, cond, obs):
     # person: person_id, year_of_birth, gender_concept_code -> age, gender_num
-    dfp = person.copy()
+    # transform emits one Person per input row, so keep one row per person_id
+    dfp = person.drop_duplicates(subset="person_id").copy()
     ycol = "year_of_birth" if "year_of_birth" in dfp.columns else "birth_datetime"
     dfp["age"] = dfp[ycol].map(year_to_age)
     dfp["gender_num"] = dfp["gender_concept_code"].map(gender_to_num)
@@ -99,7 +125,43 @@ def main():
         feat["age"] = feat["age"].fillna(feat["age"].median())
 
     # drop rows that are totally empty after fill (extremely unlikely)
-    feat = feat.dropna(subset=["age","gender_num","obs_count","cond_nunique"])
+    return feat.dropna(subset=FEATURE_COLS)
+
+def _by_person(df):
+    # person_id-indexed lookup (last row wins) so callers can .map() onto their own rows
+    df = df.assign(person_id=df["person_id"].astype(str))
+    return df.drop_duplicates(subset="person_id", keep="last").set_index("person_id")
+
+def changed_rows(feat, prev_feat):
+    # rows whose person_id is new, or whose features differ from the last snapshot
+    prev = _by_person(prev_feat)
+    ids = feat["person_id"].astype(str)
+    mask = ~ids.isin(prev.index).to_numpy()
+    for c in FEATURE_COLS:
+        old = ids.map(prev[c]).to_numpy(dtype=float)
+        mask = mask | ~np.isclose(feat[c].to_numpy(dtype=float), old, equal_nan=True)
+    return mask
+
+# ---------- main ----------
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--bucket", required=True)
+    ap.add_argument("--k", type=int, default=3)
+    ap.add_argument("--assign-only", action="store_true",
+                    help="Label only new/changed persons against the saved model instead of refitting.")
+    ap.add_argument("--drift-threshold", type=float, default=0.2,
+                    help="Refit when more than this fraction of new/changed persons lie beyond the training p95 "
+                         f"distance to their center (~0.05 without drift). Only checked with >= {MIN_DRIFT_ROWS} such persons.")
+    args = ap.parse_args()
+
+    s3 = boto3.client("s3")
+
+    # Read curated inputs produced by the pipeline
+    person = s3_read_csv(s3, args.bucket, "curated/person/person.csv")
+    cond   = s3_read_csv(s3, args.bucket, "curated/condition_occurrence/condition_occurrence.csv")
+    obs    = s3_read_csv(s3, args.bucket, "curated/observation/observation.csv")
+
+    feat = build_features(person, cond, obs)
 
     # If too few rows, print diagnostics and exit gracefully
     n = len(feat)
@@ -109,33 +171,100 @@ def main():
         # still write minimal outputs so the pipeline doesn’t break
         out = feat[["person_id"]].copy()
         out["cluster"] = 0
-        _write_outputs(out, args.bucket)
+        _write_outputs(s3, out, args.bucket)
+        # these labels don't come from the saved model, so make the next
+        # --assign-only run refit instead of reusing a stale model/snapshot
+        _drop_model(s3, args.bucket)
         return
 
+    if args.assign_only:
+        out = _assign_incremental(s3, args.bucket, feat, args.drift_threshold)
+        if out is not None:
+            _write_outputs(s3, out, args.bucket)
+            _write_features(s3, feat, args.bucket)
+            return
+
+    out = _fit_full(s3, args.bucket, feat, args.k)
+    _write_outputs(s3, out, args.bucket)
+    _write_features(s3, feat, args.bucket)
+
+def _fit_full(s3, bucket, feat, k):
     # scale numeric columns
-    cols = ["age","gender_num","obs_count","cond_nunique"]
-    feat_scaled = zscore(feat, cols)
+    params = zscore_params(feat, FEATURE_COLS)
+    feat_scaled = zscore(feat, FEATURE_COLS, params)
+
+    X = feat_scaled[FEATURE_COLS].to_numpy(dtype=float)
+    k = min(max(1, k), len(feat))  # ensure 1 <= k <= n
+    assign, centers = kmeans_numpy(X, k=k, iters=100, seed=42)
+    _, dist = nearest_center(X, centers)
 
-    X = feat_scaled[cols].to_numpy(dtype=float)
-    k = min(max(1, args.k), n)  # ensure 1 <= k <= n
-    assign = kmeans_numpy(X, k=k, iters=100, seed=42)
+    model = {
+        "cols": FEATURE_COLS,
+        "zscore": {c: list(params[c]) for c in FEATURE_COLS},
+        "centers": centers.tolist(),
+        "p95_dist": float(np.quantile(dist, DRIFT_QUANTILE)),
+    }
+    _write_model(s3, model, bucket)
 
     out = feat[["person_id"]].copy()
     out["cluster"] = assign
+    return out
+
+def _assign_incremental(s3, bucket, feat, drift_threshold):
+    # returns None whenever a full refit is needed instead
+    model = s3_read_optional(s3, bucket, MODEL_KEY, json.loads)
+    prev_feat = s3_read_optional(s3, bucket, FEATURES_KEY, lambda b: pd.read_csv(io.BytesIO(b)))
+    prev_out = s3_read_optional(s3, bucket, ASSIGN_KEY, lambda b: pd.read_csv(io.BytesIO(b)))
+    if model is None or prev_feat is None or prev_out is None:
+        print("No saved model/snapshot found; running full refit.")
+        return None
+    if model.get("cols") != FEATURE_COLS or "p95_dist" not in model:
+        print("Saved model is outdated or was fitted on different features; running full refit.")
+        return None
+
+    feat = feat.copy()
+    feat["person_id"] = feat["person_id"].astype(str)
+    labels = feat[["person_id"]].copy()
+    labels["cluster"] = labels["person_id"].map(_by_person(prev_out)["cluster"])
+    # also relabel anyone missing from the last assignments
+    mask = changed_rows(feat, prev_feat) | labels["cluster"].isna().to_numpy()
+    delta = feat[mask]
+    print(f"{len(delta)} new/changed persons out of {len(feat)}")
+    if len(delta) > 0:
+        params = {c: tuple(model["zscore"][c]) for c in FEATURE_COLS}
+        centers = np.asarray(model["centers"], dtype=float)
+        X = zscore(delta, FEATURE_COLS, params)[FEATURE_COLS].to_numpy(dtype=float)
+        assign, dist = nearest_center(X, centers)
+
+        # share of delta rows farther out than 95% of the training rows were
+        drift = float((dist > model["p95_dist"] + 1e-9).mean())
+        if len(delta) >= MIN_DRIFT_ROWS and drift > drift_threshold:
+            print(f"Drift {drift:.2f} exceeds threshold {drift_threshold:.2f}; running full refit.")
+            return None
+        labels.loc[mask, "cluster"] = assign
 
-    _write_outputs(out, args.bucket)
+    labels["cluster"] = labels["cluster"].astype(int)
+    return labels
 
-def _write_outputs(assign_df, bucket):
+def _write_model(s3, model, bucket):
+    s3_put(s3, bucket, MODEL_KEY, json.dumps(model, indent=2).encode("utf-8"), "application/json")
+    print(f"Wrote s3://{bucket}/{MODEL_KEY}")
+
+def _drop_model(s3, bucket):
+    s3.delete_object(Bucket=bucket, Key=MODEL_KEY)
+    print(f"Removed s3://{bucket}/{MODEL_KEY}")
+
+def _write_features(s3, feat, bucket):
+    # snapshot used by --assign-only to detect new/changed persons
+    body = feat[["person_id"] + FEATURE_COLS].to_csv(index=False).encode("utf-8")
+    s3_put(s3, bucket, FEATURES_KEY, body, "text/csv")
+    print(f"Wrote s3://{bucket}/{FEATURES_KEY}")
+
+def _write_outputs(s3, assign_df, bucket):
     # S3 CSV
     csv_bytes = assign_df.to_csv(index=False).encode("utf-8")
-    boto3.client("s3").put_object(
-        Bucket=bucket,
-        Key="analytics/kmeans/assignments.csv",
-        Body=csv_bytes,
-        ContentType="text/csv",
-        ServerSideEncryption="AES256"
-    )
-    print(f"Wrote s3://{bucket}/analytics/kmeans/assignments.csv")
+    s3_put(s3, bucket, ASSIGN_KEY, csv_bytes, "text/csv")
+    print(f"Wrote s3://{bucket}/{ASSIGN_KEY}")
 
     # Local copy for quick inspection
     os.makedirs("reports", exist_ok=True)
@@ -0,0 +1,118 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from aws import analytics_kmeans_stub as km
+
+BUCKET = "test-bucket"
+
+class FakeS3:
+    """In-memory stand-in for the boto3 S3 client calls the stub makes."""
+    def __init__(self, missing_code="NoSuchKey"):
+        self.store = {}
+        self.missing_code = missing_code
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.store:
+            raise ClientError({"Error": {"Code": self.missing_code}}, "GetObject")
+        return {"Body": io.BytesIO(self.store[Key])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.store[Key] = Body
+
+    def delete_object(self, Bucket, Key):
+        self.store.pop(Key, None)
+
+def make_feat(n, seed=0, start=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "person_id": [f"p{i}" for i in range(start, start + n)],
+        "age": rng.integers(20, 90, n).astype(float),
+        "gender_num": rng.integers(0, 2, n).astype(float),
+        "obs_count": rng.poisson(3, n).astype(float),
+        "cond_nunique": rng.poisson(2, n).astype(float),
+    })
+
+def fitted_s3(feat, k=3):
+    # full fit + the snapshot/assignments a previous run would have left behind
+    s3 = FakeS3()
+    out = km._fit_full(s3, BUCKET, feat, k)
+    km._write_features(s3, feat, BUCKET)
+    km.s3_put(s3, BUCKET, km.ASSIGN_KEY, out.to_csv(index=False).encode("utf-8"), "text/csv")
+    return s3, out
+
+def test_zscore_saved_params_match_fit_time():
+    feat = make_feat(50)
+    params = km.zscore_params(feat, km.FEATURE_COLS)
+    # round-trip through model.json like --assign-only does
+    saved = {c: tuple(v) for c, v in json.loads(json.dumps({c: list(params[c]) for c in params})).items()}
+    fit_time = km.zscore(feat, km.FEATURE_COLS)
+    replayed = km.zscore(feat, km.FEATURE_COLS, saved)
+    pd.testing.assert_frame_equal(fit_time, replayed)
+
+def test_changed_rows_flags_new_and_changed_only():
+    prev = make_feat(10)
+    # CSV round-trip, as the snapshot is read back from S3
+    prev = pd.read_csv(io.StringIO(prev.to_csv(index=False)))
+    cur = pd.concat([make_feat(10), make_feat(1, seed=1, start=10)], ignore_index=True)
+    cur.loc[3, "obs_count"] += 1
+    mask = km.changed_rows(cur, prev)
+    assert mask.tolist() == [i in (3, 10) for i in range(11)]
+
+def test_assign_incremental_keeps_prior_labels():
+    feat = make_feat(200)
+    s3, out = fitted_s3(feat)
+    # relabel the stored assignments so carry-over is distinguishable from recomputation
+    prior = out.assign(cluster=(out["cluster"] + 1) % 3)
+    s3.store[km.ASSIGN_KEY] = prior.to_csv(index=False).encode("utf-8")
+
+    cur = pd.concat([feat, make_feat(5, seed=1, start=200)], ignore_index=True)
+    labels = km._assign_incremental(s3, BUCKET, cur, drift_threshold=0.2)
+    assert labels is not None
+    assert len(labels) == len(cur)
+    assert labels["cluster"].iloc[:200].tolist() == prior["cluster"].tolist()
+    assert labels["cluster"].iloc[200:].between(0, 2).all()
+
+def test_assign_incremental_missing_artifact_returns_none():
+    feat = make_feat(20)
+    assert km._assign_incremental(FakeS3(), BUCKET, feat, 0.2) is None
+    # 403 is what S3 returns for a missing key without s3:ListBucket
+    assert km._assign_incremental(FakeS3(missing_code="AccessDenied"), BUCKET, feat, 0.2) is None
+
+def test_assign_incremental_drift_returns_none():
+    feat = make_feat(200)
+    s3, _ = fitted_s3(feat)
+    far = make_feat(km.MIN_DRIFT_ROWS, seed=2, start=200)
+    far["obs_count"] += 500
+    cur = pd.concat([feat, far], ignore_index=True)
+    assert km._assign_incremental(s3, BUCKET, cur, drift_threshold=0.2) is None
+
+def test_assign_incremental_small_delta_does_not_refit():
+    feat = make_feat(200)
+    s3, _ = fitted_s3(feat)
+    far = make_feat(1, seed=2, start=200)
+    far["obs_count"] += 500
+    cur = pd.concat([feat, far], ignore_index=True)
+    assert km._assign_incremental(s3, BUCKET, cur, drift_threshold=0.2) is not None
+
+def test_duplicate_person_ids():
+    person = pd.DataFrame({
+        "person_id": ["p1", "p1", "p2", "p3", "p4"],
+        "year_of_birth": [1980, 1980, 1975, 1990, 1960],
+        "gender_concept_code": ["M", "M", "F", "F", "M"],
+    })
+    cond = pd.DataFrame({"person_id": ["p1", "p1", "p2"], "condition_concept_code": ["E11", "I10", "E11"]})
+    obs = pd.DataFrame({"person_id": ["p1", "p3"]})
+    feat = km.build_features(person, cond, obs)
+    assert feat["person_id"].tolist() == ["p1", "p2", "p3", "p4"]
+
+    s3, _ = fitted_s3(feat, k=2)
+    # duplicated rows on either side must not expand the lookups
+    dup = pd.concat([feat, feat.iloc[[0]]], ignore_index=True)
+    km._write_features(s3, dup, BUCKET)
+    labels = km._assign_incremental(s3, BUCKET, dup, drift_threshold=0.2)
+    assert labels is not None
+    assert len(labels) == len(dup)